@@ -1,17 +1,65 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
 from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-from app.database import Base, engine, SessionLocal
+from sqlalchemy import insert, select, and_, or_
+from sqlalchemy.orm import Session, selectinload
+from starlette.concurrency import run_in_threadpool
+from app.database import Base, engine, SessionLocal, DB_URL
 from app import models
 from app import ocr as ocr_mod
 from app import parser as parser_mod
-from app.utils import save_upload_to_disk
+from app.utils import new_upload_path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import hashlib
 import magic
 import logging, traceback
 import os
+import threading
+
+# libmagic parst beim Init die komplette Magic-Datenbank (mehrere MB) –
+# einmalige Instanz statt pro Request; libmagic-Handles sind nicht threadsafe,
+# daher Zugriff über ein Lock
+_MIME = None
+_MIME_LOCK = threading.Lock()
+
+
+def _detect_mime(head: bytes, path: str) -> str:
+    global _MIME
+    try:
+        with _MIME_LOCK:
+            if _MIME is None:
+                _MIME = magic.Magic(mime=True)
+            return _MIME.from_buffer(head)
+    except Exception:
+        try:
+            return magic.Magic(mime=True).from_file(path)
+        except Exception:
+            return "application/octet-stream"
 
 MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "25"))
+# OCR ist CPU-gebunden (Tesseract + Preprocessing) und läuft daher in einem
+# Prozess-Pool, damit der Event-Loop nicht blockiert wird.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "2"))
+_ocr_pool: ProcessPoolExecutor | None = None
+
+
+def _get_ocr_pool() -> ProcessPoolExecutor:
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ProcessPoolExecutor(max_workers=OCR_WORKERS)
+    return _ocr_pool
+
+
+def _reset_ocr_pool():
+    """Kaputten Pool verwerfen; der nächste _get_ocr_pool() baut einen neuen."""
+    global _ocr_pool
+    if _ocr_pool is not None:
+        try:
+            _ocr_pool.shutdown(wait=False, cancel_futures=True)
+        except Exception:
+            pass
+        _ocr_pool = None
 
 app = FastAPI(title="OCR Belege – Schritt 1")
 
@@ -22,6 +70,59 @@ logger = logging.getLogger("ocr-belege")
 # DB erstellen (SQLite-Datei im gemounteten Volume)
 Base.metadata.create_all(bind=engine)
 
+
+def _ensure_sqlite_schema():
+    """Minimale Schema-Upgrades für bestehende SQLite-Datenbanken.
+
+    create_all legt nur fehlende Tabellen an; das persistente Volume behält
+    aber die alte SQLite-Datei. Neue Spalten müssen daher beim Start per
+    ALTER TABLE nachgezogen werden, sonst schlagen alle Receipt-SELECTs fehl.
+    """
+    if not DB_URL.startswith("sqlite"):
+        return
+    try:
+        with engine.begin() as conn:
+            cols = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(receipts)")]
+            if cols and "status" not in cols:
+                # Bestandszeilen wurden vom alten synchronen Pfad vollständig
+                # verarbeitet, daher 'done' statt 'queued'
+                conn.exec_driver_sql(
+                    "ALTER TABLE receipts ADD COLUMN status VARCHAR(16) DEFAULT 'done'"
+                )
+                logger.info("SCHEMA: added receipts.status column")
+            # Index zur Spalte (index=True am Modell) ebenfalls nachziehen,
+            # sonst laufen die Status-Abfragen auf Altdatenbanken als Full Scan
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_receipts_status ON receipts (status)"
+            )
+
+            # Unique-Index auf stores(name, chain) – Voraussetzung für den
+            # INSERT OR IGNORE-Pfad. Vorher Duplikate aus Altbeständen auf die
+            # jeweils kleinste id zusammenführen, sonst schlägt der Index fehl.
+            conn.exec_driver_sql(
+                "UPDATE receipts SET store_id = ("
+                "  SELECT MIN(s2.id) FROM stores s2 JOIN stores s1 ON s1.id = receipts.store_id"
+                "  WHERE s2.name IS s1.name AND s2.chain IS s1.chain"
+                ") WHERE store_id IS NOT NULL"
+            )
+            deleted = conn.exec_driver_sql(
+                "DELETE FROM stores WHERE id NOT IN "
+                "(SELECT MIN(id) FROM stores GROUP BY name, chain)"
+            ).rowcount
+            if deleted:
+                logger.info("SCHEMA: merged %d duplicate store rows", deleted)
+            conn.exec_driver_sql(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_stores_name_chain ON stores (name, chain)"
+            )
+            conn.exec_driver_sql(
+                "CREATE INDEX IF NOT EXISTS ix_receipts_store_time ON receipts (store_id, purchase_datetime)"
+            )
+    except Exception as e:
+        logger.error("SCHEMA: upgrade failed: %s\n%s", e, traceback.format_exc())
+
+
+_ensure_sqlite_schema()
+
 # Ensure /data/debug exists when OCR_DEBUG_DUMP=1 and write a marker file
 if os.getenv("OCR_DEBUG_DUMP", "0") == "1":
     try:
@@ -35,40 +136,112 @@ if os.getenv("OCR_DEBUG_DUMP", "0") == "1":
 # Serve uploaded files (download links)
 UPLOAD_DIR = "/data/uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-app.mount("/files", StaticFiles(directory=UPLOAD_DIR), name="files")
 
+# OCR-Cache: Ergebnisse nach Datei-Hash, damit identische Uploads nicht erneut
+# durch Tesseract laufen (ocr_file ist deterministisch über die Bytes)
+CACHE_DIR = "/data/cache"
+os.makedirs(CACHE_DIR, exist_ok=True)
 
-@app.post("/api/upload", response_model=None)
-async def upload_receipt(file: UploadFile = File(...)):
+
+def _cached_ocr_text(content_hash: str) -> str | None:
     try:
-        # Datei einlesen (im Speicher) und Größe prüfen
-        content = await file.read()
-        size = len(content)
-        logger.info("UPLOAD: name=%s size=%d bytes", file.filename, size)
-        if size > MAX_UPLOAD_MB * 1024 * 1024:
-            raise HTTPException(status_code=413, detail="Datei zu groß")
-
-        # Auf Disk speichern
-        path = save_upload_to_disk(file.filename, content)
-        logger.info("UPLOAD: saved to %s", path)
-
-        # Mimetype prüfen – robust mit Fallback
-        try:
-            m = magic.Magic(mime=True)
-            mime = m.from_buffer(content[:4096])
-        except Exception:
-            try:
-                mime = magic.Magic(mime=True).from_file(path)
-            except Exception:
-                mime = "application/octet-stream"
-        logger.info("UPLOAD: mime=%s", mime)
-        if not ("image" in mime or "pdf" in mime or file.filename.lower().endswith((".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"))):
-            raise HTTPException(status_code=415, detail=f"Nicht unterstützter Typ: {mime}")
+        cache_path = os.path.join(CACHE_DIR, f"{content_hash}.txt")
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                text = f.read()
+            # Leere Einträge (z.B. aus älteren Versionen) nicht als Treffer
+            # werten – ein erneuter OCR-Versuch kann mehr liefern
+            if text:
+                return text
+    except Exception as e:
+        logger.warning("CACHE: read failed for %s: %s", content_hash, e)
+    return None
 
-        # OCR
-        logger.info("UPLOAD: calling OCR for %s", path)
-        text = ocr_mod.ocr_file(path)
-        logger.info("UPLOAD: OCR returned len=%d", len(text or ""))
+
+def _store_ocr_text(content_hash: str, text: str):
+    # Leeres OCR-Ergebnis nicht cachen: ocr_file liefert \"\" auch bei
+    # transienten Fehlern (Tesseract-Crash, unlesbare Datei), und ein
+    # gecachter Fehlschlag würde jeden Retry für diese Bytes verhindern
+    if not text:
+        return
+    try:
+        cache_path = os.path.join(CACHE_DIR, f"{content_hash}.txt")
+        with open(cache_path, "w", encoding="utf-8") as f:
+            f.write(text)
+    except Exception as e:
+        logger.warning("CACHE: write failed for %s: %s", content_hash, e)
+
+
+def resolve_store_ids(db: Session, pairs) -> dict:
+    """Map (name, chain) pairs to Store-IDs und lege fehlende Stores in einem Rutsch an.
+
+    Ein INSERT OR IGNORE (gedeckt durch den Unique-Index auf name/chain) plus
+    ein SELECT statt SELECT+INSERT pro Store – skaliert für Batch-Import
+    genauso wie für den Einzel-Upload. Ergebnis ist nach dem vollen
+    (name, chain)-Paar gekeyt, damit gleiche Namen unter verschiedenen Ketten
+    nicht kollidieren. SQLite-spezifisch.
+    """
+    pairs = [(n, c) for n, c in dict.fromkeys(pairs) if n]
+    if not pairs:
+        return {}
+
+    def _select_pairs(wanted):
+        rows = db.execute(
+            select(models.Store.id, models.Store.name, models.Store.chain)
+            .where(or_(*[
+                and_(
+                    models.Store.name == n,
+                    models.Store.chain.is_(None) if c is None else models.Store.chain == c,
+                )
+                for n, c in wanted
+            ]))
+            .order_by(models.Store.id)
+        ).all()
+        found = {}
+        for store_id, name, chain in rows:
+            found.setdefault((name, chain), store_id)
+        return found
+
+    # Erst nachschlagen, dann nur Fehlendes einfügen: der Unique-Index fängt
+    # Rennen bei gesetzter chain ab, behandelt NULL-chains aber als distinkt –
+    # blindes OR IGNORE würde solche Paare bei jedem Aufruf neu anlegen
+    result = _select_pairs(pairs)
+    missing = [p for p in pairs if p not in result]
+    if missing:
+        db.execute(
+            insert(models.Store)
+            .prefix_with("OR IGNORE")
+            .values([{"name": n, "chain": c} for n, c in missing])
+        )
+        result.update(_select_pairs(missing))
+    return result
+
+
+async def process_receipt(receipt_id: int, path: str, content_hash: str | None = None):
+    """Hintergrund-Job: OCR + Parsen + Ergebnis in die DB schreiben.
+
+    Läuft nach der HTTP-Antwort; OCR selbst in einem Prozess-Pool, damit weder
+    Event-Loop noch andere Uploads blockiert werden.
+    """
+    try:
+        logger.info("WORKER: start receipt_id=%s path=%s", receipt_id, path)
+        text = _cached_ocr_text(content_hash) if content_hash else None
+        if text is not None:
+            logger.info("WORKER: OCR cache hit for %s len=%d", content_hash, len(text))
+        else:
+            loop = asyncio.get_running_loop()
+            try:
+                text = await loop.run_in_executor(_get_ocr_pool(), ocr_mod.ocr_file, path)
+            except BrokenProcessPool:
+                # Ein abgestürzter Worker (Segfault/OOM in libtesseract) macht
+                # den Pool dauerhaft unbrauchbar – neu aufbauen und einmal
+                # wiederholen statt alle weiteren Uploads scheitern zu lassen
+                logger.warning("WORKER: OCR process pool broken, rebuilding and retrying %s", path)
+                _reset_ocr_pool()
+                text = await loop.run_in_executor(_get_ocr_pool(), ocr_mod.ocr_file, path)
+            logger.info("WORKER: OCR returned len=%d", len(text or ""))
+            if content_hash:
+                _store_ocr_text(content_hash, text or "")
 
         if os.getenv("OCR_DEBUG_DUMP", "0") == "1":
             try:
@@ -86,32 +259,92 @@ async def upload_receipt(file: UploadFile = File(...)):
         store_name, chain_name, total = parser_mod.parse_store_and_total(text or "")
         logger.info("PARSE: store=%s chain=%s total=%s", store_name, chain_name, total)
 
-        # Persistieren
+        # Persistieren: Store-Lookup/-Insert und Receipt-Update in einer
+        # einzigen Transaktion (ein Commit = ein fsync)
         with SessionLocal() as db:
-            store = None
-            if store_name or chain_name:
-                store = (
-                    db.query(models.Store)
-                    .filter(models.Store.name == (store_name or chain_name))
-                    .first()
-                )
-                if not store:
-                    store = models.Store(name=store_name or chain_name, chain=chain_name)
-                    db.add(store)
-                    db.flush()
-            receipt = models.Receipt(
-                store_id=store.id if store else None,
-                raw_text=text or "",
-                source_file=path,
-                total=total,
-            )
+            with db.begin():
+                store_id = None
+                if store_name or chain_name:
+                    name = store_name or chain_name
+                    store_id = resolve_store_ids(db, [(name, chain_name)]).get((name, chain_name))
+                receipt = db.query(models.Receipt).get(receipt_id)
+                if not receipt:
+                    logger.error("WORKER: receipt id=%s vanished, dropping result", receipt_id)
+                    return
+                receipt.store_id = store_id
+                receipt.raw_text = text or ""
+                receipt.total = total
+                receipt.status = "done"
+            logger.info("DB: updated receipt id=%s file=%s total=%s", receipt_id, path, total)
+    except Exception as e:
+        logger.error("WORKER: processing failed for receipt id=%s: %s\n%s", receipt_id, e, traceback.format_exc())
+        try:
+            with SessionLocal() as db:
+                receipt = db.query(models.Receipt).get(receipt_id)
+                if receipt:
+                    receipt.status = "failed"
+                    db.commit()
+        except Exception:
+            logger.error("WORKER: failed to mark receipt id=%s as failed", receipt_id)
+
+
+@app.post("/api/upload", response_model=None, status_code=202)
+async def upload_receipt(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    try:
+        # In Chunks auf Disk streamen statt den ganzen Body im RAM zu puffern;
+        # Größe und SHA-256 werden dabei inkrementell mitgerechnet
+        path = new_upload_path(file.filename)
+        max_bytes = MAX_UPLOAD_MB * 1024 * 1024
+        hasher = hashlib.sha256()
+        size = 0
+        head = b""
+        try:
+            # Datei-I/O über den Threadpool, damit Schreib-Syscalls den
+            # Event-Loop nicht blockieren (synchrones write() in einem
+            # async-Handler stallt sonst alle parallelen Requests)
+            out = await run_in_threadpool(open, path, "wb")
+            try:
+                while chunk := await file.read(1 << 20):
+                    if not head:
+                        head = chunk[:4096]
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise HTTPException(status_code=413, detail="Datei zu groß")
+                    hasher.update(chunk)
+                    await run_in_threadpool(out.write, chunk)
+            finally:
+                await run_in_threadpool(out.close)
+        except HTTPException:
+            # Teilgeschriebene Datei aufräumen
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            raise
+        finally:
+            # Spool-Datei des Uploads sofort freigeben statt erst am Request-Ende
+            await file.close()
+        content_hash = hasher.hexdigest()
+        logger.info("UPLOAD: name=%s size=%d bytes saved to %s sha256=%s", file.filename, size, path, content_hash)
+
+        # Mimetype prüfen – robust mit Fallback (head stammt aus dem ersten Chunk)
+        mime = _detect_mime(head, path)
+        logger.info("UPLOAD: mime=%s", mime)
+        if not ("image" in mime or "pdf" in mime or file.filename.lower().endswith((".pdf", ".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"))):
+            raise HTTPException(status_code=415, detail=f"Nicht unterstützter Typ: {mime}")
+
+        # Pending-Beleg anlegen; OCR läuft asynchron im Hintergrund
+        with SessionLocal() as db:
+            receipt = models.Receipt(raw_text="", source_file=path, status="queued")
             db.add(receipt)
             db.commit()
             db.refresh(receipt)
-            logger.info("DB: saved receipt id=%s file=%s total=%s", receipt.id, path, total)
+            logger.info("DB: queued receipt id=%s file=%s", receipt.id, path)
+
+        background_tasks.add_task(process_receipt, receipt.id, path, content_hash)
 
         download_url = f"/files/{os.path.basename(path)}"
-        return {"status": "ok", "receipt_id": receipt.id, "download_url": download_url, "parsed_total": total}
+        return {"status": "queued", "receipt_id": receipt.id, "download_url": download_url}
     except HTTPException:
         # Durchreichen von kontrollierten API-Fehlern
         raise
@@ -125,19 +358,25 @@ async def upload_receipt(file: UploadFile = File(...)):
 def list_receipts(limit: int = 50, offset: int = 0):
     """Listet Belege paginiert auf (neueste zuerst)."""
     with SessionLocal() as db:
-        q = db.query(models.Receipt).order_by(models.Receipt.id.desc()).offset(offset).limit(limit)
+        # selectinload holt alle Stores in einem zweiten SELECT statt N+1
+        q = (
+            db.query(models.Receipt)
+            .options(selectinload(models.Receipt.store))
+            .order_by(models.Receipt.id.desc())
+            .offset(offset)
+            .limit(limit)
+        )
         rows = q.all()
         data = []
         for r in rows:
             store = None
-            if r.store_id:
-                s = db.query(models.Store).get(r.store_id)
-                if s:
-                    store = {"id": s.id, "name": s.name, "chain": s.chain}
+            if r.store:
+                store = {"id": r.store.id, "name": r.store.name, "chain": r.store.chain}
             data.append({
                 "id": r.id,
                 "store": store,
                 "purchase_datetime": r.purchase_datetime.isoformat(),
+                "status": r.status,
                 "total": r.total,
                 "download_url": f"/files/{os.path.basename(r.source_file)}" if r.source_file else None,
             })
@@ -147,18 +386,22 @@ def list_receipts(limit: int = 50, offset: int = 0):
 @app.get("/api/receipts/{receipt_id}")
 def get_receipt(receipt_id: int):
     with SessionLocal() as db:
-        r = db.query(models.Receipt).get(receipt_id)
+        r = (
+            db.query(models.Receipt)
+            .options(selectinload(models.Receipt.store))
+            .filter(models.Receipt.id == receipt_id)
+            .first()
+        )
         if not r:
             raise HTTPException(status_code=404, detail="Receipt not found")
         store = None
-        if r.store_id:
-            s = db.query(models.Store).get(r.store_id)
-            if s:
-                store = {"id": s.id, "name": s.name, "chain": s.chain}
+        if r.store:
+            store = {"id": r.store.id, "name": r.store.name, "chain": r.store.chain}
         return {
             "id": r.id,
             "store": store,
             "purchase_datetime": r.purchase_datetime.isoformat(),
+            "status": r.status,
             "currency": r.currency,
             "total": r.total,
             "source_file": r.source_file,
@@ -168,6 +411,17 @@ def get_receipt(receipt_id: int):
 
 
 
+# Download endpoint for uploaded files. FileResponse streams via the OS
+# (sendfile on Linux) instead of StaticFiles' Python-level reads.
+@app.get("/files/{name}")
+def download_file(name: str):
+    safe = os.path.basename(name)
+    path = os.path.join(UPLOAD_DIR, safe)
+    if safe != name or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="File not found")
+    return FileResponse(path)
+
+
 @app.get("/", response_class=HTMLResponse)
 def index_page():
     # Serve the UI from app/static/index.html so PyCharm/Compose share the same file
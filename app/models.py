@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Float
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Float, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database import Base
@@ -12,6 +12,10 @@ class Store(Base):
     country = Column(String(2), default="CH")
     receipts = relationship("Receipt", back_populates="store")
 
+    # Unique macht den Lookup beim Upload O(log n) und verhindert Duplikate;
+    # Voraussetzung für INSERT OR IGNORE beim Batch-Import
+    __table_args__ = (Index("ix_stores_name_chain", "name", "chain", unique=True),)
+
 class Receipt(Base):
     __tablename__ = "receipts"
     id = Column(Integer, primary_key=True)
@@ -20,12 +24,16 @@ class Receipt(Base):
     raw_text = Column(Text)
     source_file = Column(String(512))  # Pfad zur Originaldatei
     ocr_engine = Column(String(64), default="tesseract")
+    status = Column(String(16), default="queued", index=True)  # queued | done | failed
     currency = Column(String(3), default="CHF")
     total = Column(Float, nullable=True)
 
     store = relationship("Store", back_populates="receipts")
     lines = relationship("LineItem", back_populates="receipt", cascade="all, delete-orphan")
 
+    # Für spätere Abfragen "Belege eines Stores, neueste zuerst" ohne Full Scan
+    __table_args__ = (Index("ix_receipts_store_time", "store_id", "purchase_datetime"),)
+
 class LineItem(Base):
     __tablename__ = "line_items"
     id = Column(Integer, primary_key=True)
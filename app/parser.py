@@ -1,12 +1,39 @@
 import re
 from typing import Optional, Tuple, List
 
-STORE_PATTERNS = [
-    (re.compile(r"migros", re.I), ("Migros", "Migros")),
-    (re.compile(r"coop", re.I), ("Coop", "Coop")),
-    (re.compile(r"aldi", re.I), ("Aldi", "Aldi")),
-    (re.compile(r"lidl", re.I), ("Lidl", "Lidl")),
-]
+# Ketten-Schlüsselwörter (kleingeschrieben) -> (Store-Name, Ketten-Name)
+STORE_KEYWORDS = {
+    "migros": ("Migros", "Migros"),
+    "coop": ("Coop", "Coop"),
+    "aldi": ("Aldi", "Aldi"),
+    "lidl": ("Lidl", "Lidl"),
+}
+
+# Aho-Corasick: alle Ketten in einem Durchlauf über den Text statt einer
+# Regex-Suche pro Kette; fällt ohne pyahocorasick auf die Schleife zurück
+try:
+    import ahocorasick
+
+    _STORE_AUTOMATON = ahocorasick.Automaton()
+    for kw, names in STORE_KEYWORDS.items():
+        _STORE_AUTOMATON.add_word(kw, names)
+    _STORE_AUTOMATON.make_automaton()
+except ImportError:
+    _STORE_AUTOMATON = None
+
+
+def _detect_store(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """Find the first known store chain mentioned in the text."""
+    t = text.lower()
+    if _STORE_AUTOMATON is not None:
+        for _, names in _STORE_AUTOMATON.iter(t):
+            return names
+        return None, None
+    # str.__contains__ (memmem) beats a case-insensitive regex scan per keyword
+    for kw, names in STORE_KEYWORDS.items():
+        if kw in t:
+            return names
+    return None, None
 
 # Enhanced patterns:
 # - Accepts labels like TOTAL, SUMME, GESAMT(BETRAG), ZU ZAHLEN/BEZAHLEN, ZAHLBETRAG, TOTALBETRAG
@@ -16,16 +43,26 @@ AMOUNT_GROUP = r"([0-9]{1,3}(?:[\'\s\.,][0-9]{3})*[.,][0-9]{2}|[0-9]+[.,][0-9]{2
 CURRENCY = r"(?:CHF|Fr\.?|SFr\.?|EUR|€)"
 LABEL = r"(?:TOTAL|SUMME|GESAMT(?:BETRAG)?|TOTALBETRAG|ZU\s*(?:ZAHLEN|BEZAHLEN)|ZAHLBETRAG)"
 
-TOTAL_PATTERNS: List[re.Pattern] = [
-    # Label then amount, maybe currency in between
-    re.compile(rf"{LABEL}\s*[:=]?\s*(?:{CURRENCY}\s*)?{AMOUNT_GROUP}", re.I),
-    # Label then amount then currency
-    re.compile(rf"{LABEL}\s*[:=]?\s*{AMOUNT_GROUP}\s*(?:{CURRENCY})", re.I),
-    # Standalone line with currency then amount (multiline)
-    re.compile(rf"^(?:{CURRENCY})\s*{AMOUNT_GROUP}\s*$", re.I | re.M),
-    # Standalone line with amount then currency (multiline)
-    re.compile(rf"^{AMOUNT_GROUP}\s*(?:{CURRENCY})\s*$", re.I | re.M),
-]
+def _amount_group(name: str) -> str:
+    return AMOUNT_GROUP.replace("(", f"(?P<{name}>", 1)
+
+
+# Single fused pattern: one pass over the text instead of four. Each
+# alternative carries its own named amount group so the matching branch
+# can be identified via the non-None group.
+TOTAL_PATTERN: re.Pattern = re.compile(
+    "|".join([
+        # Label then amount, maybe currency in between
+        rf"{LABEL}\s*[:=]?\s*(?:{CURRENCY}\s*)?{_amount_group('amt1')}",
+        # Label then amount then currency
+        rf"{LABEL}\s*[:=]?\s*{_amount_group('amt2')}\s*(?:{CURRENCY})",
+        # Standalone line with currency then amount (multiline)
+        rf"^(?:{CURRENCY})\s*{_amount_group('amt3')}\s*$",
+        # Standalone line with amount then currency (multiline)
+        rf"^{_amount_group('amt4')}\s*(?:{CURRENCY})\s*$",
+    ]),
+    re.I | re.M,
+)
 
 
 def _rightmost_amount_in_line(line: str) -> Optional[float]:
@@ -46,6 +83,21 @@ def _rightmost_amount_in_line(line: str) -> Optional[float]:
     return None
 
 
+# Nur die letzten ~2 KB zuerst absuchen – dort steht das Total praktisch immer
+TAIL_SCAN_CHARS = 2048
+
+
+def _total_candidates(segment: str) -> List[Tuple[int, float]]:
+    """Collect (position, amount) pairs for all total matches in the segment."""
+    out: List[Tuple[int, float]] = []
+    for m in TOTAL_PATTERN.finditer(segment):
+        raw = m.group(m.lastgroup) if m.lastgroup else None  # amount group of the matching alternative
+        val = _normalize_amount_to_float(raw) if raw else None
+        if val is not None:
+            out.append((m.start(), val))
+    return out
+
+
 def _parse_total_by_lines(text: str) -> Optional[float]:
     """
     Fallback: look for any line containing TOTAL/SUMME/etc. and
@@ -59,24 +111,27 @@ def _parse_total_by_lines(text: str) -> Optional[float]:
     return None
 
 
+# Entfernt Leerzeichen/Apostrophe (Tausendertrenner) in einem Durchlauf
+_THOUSANDS_TRANS = str.maketrans("", "", " '")
+
+
 def _normalize_amount_to_float(s: str) -> Optional[float]:
     """
     Normalize strings like "1'234.56", "1 234,56", "1234,56", "1234.56" to float.
     """
     if not s:
         return None
-    s = s.strip()
-    # Remove spaces and apostrophes used as thousands separators
-    s = s.replace(" ", "").replace("'", "")
-    # If both '.' and ',' exist, assume '.' thousands, ',' decimal (common in DE/CH)
-    if "." in s and "," in s:
-        s = s.replace(".", "")
+    s = s.strip().translate(_THOUSANDS_TRANS)
+    # The rightmost of '.'/',' is the decimal separator; the other (if any)
+    # separates thousands. Covers both DE/CH "1.234,56" and "1,234.56".
+    last_dot = s.rfind(".")
+    last_comma = s.rfind(",")
+    if last_comma > last_dot:
+        if last_dot >= 0:
+            s = s.replace(".", "")
         s = s.replace(",", ".")
-    else:
-        # If only comma exists, treat as decimal separator
-        if "," in s and "." not in s:
-            s = s.replace(",", ".")
-        # If only dot exists, keep as is
+    elif last_comma >= 0:
+        s = s.replace(",", "")
     try:
         return float(s)
     except ValueError:
@@ -84,21 +139,18 @@ def _normalize_amount_to_float(s: str) -> Optional[float]:
 
 
 def parse_store_and_total(text: str) -> Tuple[Optional[str], Optional[str], Optional[float]]:
-    chain_name = None
-    store_name = None
-    for pat, (sname, cname) in STORE_PATTERNS:
-        if pat.search(text):
-            store_name, chain_name = sname, cname
-            break
-
-    # Find all candidate totals, take the last occurrence in the document
+    store_name, chain_name = _detect_store(text)
+
+    # Find all candidate totals, take the last occurrence in the document.
+    # Totals sit at the end of a receipt, so scan only the tail first and
+    # fall back to the full text when the tail yields nothing.
     candidates: List[Tuple[int, float]] = []
-    for pat in TOTAL_PATTERNS:
-        for m in pat.finditer(text):
-            raw = m.group(1)  # always capture group for amount
-            val = _normalize_amount_to_float(raw)
-            if val is not None:
-                candidates.append((m.start(), val))
+    if len(text) > TAIL_SCAN_CHARS:
+        # align the tail to a line start so the ^-anchored alternatives work
+        start = text.rfind("\n", 0, len(text) - TAIL_SCAN_CHARS) + 1
+        candidates = _total_candidates(text[start:])
+    if not candidates:
+        candidates = _total_candidates(text)
 
     total: Optional[float] = None
     if candidates:
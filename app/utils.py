@@ -4,11 +4,9 @@ def ensure_dirs():
     os.makedirs("/data/uploads", exist_ok=True)
 
 
-def save_upload_to_disk(filename: str, content: bytes) -> str:
+def new_upload_path(filename: str) -> str:
+    """Reserve a unique on-disk path for an upload (caller writes the bytes)."""
     ensure_dirs()
     ext = os.path.splitext(filename)[1].lower() or ".bin"
     safe = f"{uuid.uuid4().hex}{ext}"
-    path = f"/data/uploads/{safe}"
-    with open(path, "wb") as f:
-        f.write(content)
-    return path
\ No newline at end of file
+    return f"/data/uploads/{safe}"
\ No newline at end of file